@@ -1,28 +1,16 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 # vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
-from __future__ import (unicode_literals, division, absolute_import,
-                        print_function)
 
 __license__   = 'GPL v3'
 __copyright__ = '2021, Igor Kaldowski <>'
 __docformat__ = 'restructuredtext en'
 
-import time, json, re
-
-try:
-    from urllib.parse import quote
-except ImportError:
-    from urllib import quote
-
-try:
-    from queue import Empty, Queue
-except ImportError:
-    from Queue import Empty, Queue
-import six
-from six import text_type as unicode
-
-from lxml.html import fromstring
+import time
+from threading import Lock
+from concurrent.futures import wait
+from urllib.parse import quote
+from queue import Empty, Queue
 
 from calibre import as_unicode
 from calibre import prints
@@ -30,23 +18,16 @@ from calibre.ebooks.metadata.sources.base import Source
 from calibre.utils.icu import lower
 from calibre.utils.cleantext import clean_ascii_chars
 from calibre.utils.localization import get_udc
-# from calibre.ebooks.metadata import check_isbn
 
 from calibre.constants import DEBUG
 
-import sys
-from PyQt5 import Qt as QtGui
-from PyQt5.QtCore import *
-from PyQt5.Qt import QLabel, QTableWidget,  QIcon,  QPixmap
-from PyQt5.QtWidgets import *
-
 class Audible(Source):
 
     name                    = 'Audible'
     description             = _('Download book metadata and covers from Audible')
     author                  = 'Igor Kaldowski'
     version                 = (0,  0, 1)
-    minimum_calibre_version = (3, 41, 0)
+    minimum_calibre_version = (5, 0, 0)
 
     capabilities = frozenset(['identify', 'cover'])
     touched_fields = frozenset(['title', 'authors', 'identifier:audible',
@@ -66,10 +47,17 @@ class Audible(Source):
     AUDNEXUS_PATH = '/books/'
     
     AUDIBLE_QUERY = '?ipRedirectOverride=true'
-    AUDIBLE_API_QUERY = 'num_results=25&products_sort_by=Relevance'
+    AUDIBLE_API_QUERY = ('num_results=25&products_sort_by=Relevance'
+        '&response_groups=contributors,product_desc,product_attrs,media,series,'
+        'rating,product_extended_attrs,category_ladders&image_sizes=500,1024,2400')
     AUDIBLE_API_TITLE_QUERY = '&title='
     AUDIBLE_API_AUTHOR_QUERY = '&author='
 
+    # Cover urls found by the last identify(), used by download_cover()
+    RECENT_IDENTIFY_TTL = 60
+    _last_identify = None
+    _last_identify_lock = Lock()
+
     def config_widget(self):
         '''
         Overriding the default configuration screen for our own custom configuration
@@ -81,26 +69,49 @@ class Audible(Source):
         audible_id = identifiers.get(self.ID_NAME, None)
         if audible_id:
             return (self.ID_NAME, audible_id,
-                    '%s%s%s%s'%(Audible.AUDIBLE_URL, Audible.AUDIBLE_PATH, audible_id, Audible.AUDIBLE_QUERY))
+                    f'{self.AUDIBLE_URL}{self.AUDIBLE_PATH}{audible_id}{self.AUDIBLE_QUERY}')
 
     def create_query(self, log, title=None, authors=None, identifiers={}, asin=None):
-        audible_id = identifiers.get(self.ID_NAME, None)
-        if asin:
-            audible_id = asin
-        
-        q = ''
+        audible_id = asin or identifiers.get(self.ID_NAME, None)
+
         if audible_id:
-            q = self.AUDNEXUS_URL + self.AUDNEXUS_PATH + audible_id
-        elif title or authors:
-            q = self.AUDIBLE_API_URL + self.AUDIBLE_API_PATH + self.AUDIBLE_API_QUERY
-            if title:
-                q = q + self.AUDIBLE_API_TITLE_QUERY + title
-            if authors:
-                q = q + self.AUDIBLE_API_AUTHOR_QUERY + authors[0]
-
-        if not q:
+            return ''.join((self.AUDNEXUS_URL, self.AUDNEXUS_PATH, audible_id))
+        if not (title or authors):
             return None
-        return q
+
+        parts = [self.AUDIBLE_API_URL, self.AUDIBLE_API_PATH, self.AUDIBLE_API_QUERY]
+        if title:
+            parts += [self.AUDIBLE_API_TITLE_QUERY, quote(title)]
+        if authors:
+            parts += [self.AUDIBLE_API_AUTHOR_QUERY, quote(authors[0])]
+        return ''.join(parts)
+
+    def _match_tokens(self, title, authors):
+        udc = get_udc()
+        tokens = list(self.get_title_tokens(title or '', strip_joiners=False))
+        tokens += list(self.get_author_tokens(authors or [], only_first_author=False))
+        return set(lower(udc.decode(t)) for t in tokens)
+
+    def best_products(self, products, title, authors):
+        '''
+        Keep only the search results closest to title/authors, so we do not
+        build and fetch details for candidates that would never be chosen.
+        '''
+        import calibre_plugins.audible.config as cfg
+        limit = cfg.get_plugin_pref(cfg.STORE_NAME, cfg.KEY_MAX_CANDIDATES)
+        if len(products) <= limit:
+            return products
+
+        wanted = self._match_tokens(title, authors)
+        def score(i):
+            product = products[i]
+            found = self._match_tokens(product.get('title'),
+                    [a.get('name') for a in product.get('authors') or [] if a.get('name')])
+            union = wanted | found
+            return len(wanted & found) / len(union) if union else 0
+        best = sorted(range(len(products)), key=lambda i: (-score(i), i))[:limit]
+        # Keep Audible's own relevance order among the survivors
+        return [products[i] for i in sorted(best)]
 
     def get_cached_cover_url(self, identifiers):
         url = None
@@ -116,79 +127,117 @@ class Audible(Source):
         Note this method will retry without identifiers automatically if no
         match is found with identifiers.
         '''
-        audible_id = identifiers.get(self.ID_NAME, None)
-
         matches = []
         audible_id = identifiers.get(self.ID_NAME, None)
         log.info('\nTitle: %s\nAuthors: %s\n'%(title, authors))
         br = self.browser
+        from calibre_plugins.audible.worker import (Worker, get_error_code,
+                product_to_book, get_executor, audible_search)
 
         if audible_id:
-            matches.append(self.create_query(log, title=title, authors=authors, identifiers=identifiers))
+            matches.append((self.create_query(log, title=title, authors=authors, identifiers=identifiers), None))
         else:
             query = self.create_query(log, title=title, authors=authors, identifiers=identifiers)
 
-            response = None
             if query is None:
                 log.error('Insufficient metadata to construct query')
                 return
 
             try:
                 log.info('Query: %s'%query)
-                response = br.open_novisit(query, timeout=timeout)
+                raw = audible_search(query, br, timeout)
 
             except Exception as e:
-                if callable(getattr(e, 'getcode', None)) and e.getcode() == 404:
+                if get_error_code(e) == 404:
                     log.error('No matches for identify query')
                     return as_unicode(e)
+                msg = 'Failed to get Audible results for query'
+                log.exception(msg)
+                return msg
 
-            if response:
-                try:
-                    raw = response.read()
-                    raw = json.loads(raw)
-                    if not raw:
-                        log.error('Failed to get raw result for query')
-                        return
-                    for product in raw["products"]:
-                        matches.append(self.create_query(log, title=title, authors=authors, identifiers=identifiers, asin=product["asin"]))
-                except:
-                    msg = 'Failed to get Audible results for query'
-                    log.exception(msg)
-                    return msg
+            if not raw:
+                log.error('Failed to get raw result for query')
+                return
+            try:
+                products = self.best_products(raw["products"], title, authors)
+                for product in products:
+                    # The search already returns most of the details, only
+                    # go to Audnexus when something essential is missing
+                    matches.append((self.create_query(log, title=title, authors=authors, identifiers=identifiers, asin=product["asin"]),
+                            product_to_book(product)))
+            except:
+                msg = 'Failed to get Audible results for query'
+                log.exception(msg)
+                return msg
 
         if abort.is_set():
             return
         
-        from calibre_plugins.audible.worker import Worker
-        workers = [Worker(url, result_queue, br, log, i, self) for i, url in
-                enumerate(matches)]
-
-        for w in workers:
-            w.start()
-            # Don't send all requests at the same time
-            time.sleep(0.1)
-
-        while not abort.is_set():
-            a_worker_is_alive = False
-            for w in workers:
-                w.join(0.2)
-                if abort.is_set():
-                    break
-                if w.is_alive():
-                    a_worker_is_alive = True
-            if not a_worker_is_alive:
-                break
+        workers = []
+        to_fetch = []
+        for i, (url, book) in enumerate(matches):
+            if book is None:
+                w = Worker(url, result_queue, br, log, i, self)
+                to_fetch.append(w)
+            else:
+                # Nothing to fetch, so no browser to clone
+                w = Worker(url, result_queue, None, log, i, self)
+                w.parse_details(book)
+            workers.append(w)
+
+        executor = get_executor()
+        pending = set(executor.submit(w.run) for w in to_fetch)
+        # One wakeup per tick to check abort, not one per finished worker
+        while pending and not abort.is_set():
+            pending = wait(pending, timeout=0.2).not_done
+        if pending:
+            for f in pending:
+                f.cancel()
+            return None
+
+        keygen = self.identify_results_keygen(title=title, authors=authors,
+                identifiers=identifiers)
+        # Same ranking download_cover() applies to a fresh identify()
+        results = [w for w in workers if w.mi is not None and w.cover_url]
+        results.sort(key=lambda w: keygen(w.mi))
+        cover_urls = [w.cover_url for w in results]
+        with self._last_identify_lock:
+            self._last_identify = (time.time(),
+                    self._identify_key(title, authors, identifiers), cover_urls)
 
         return None
 
+    def _identify_key(self, title, authors, identifiers):
+        return (lower(title or '').strip(),
+                tuple(lower(a).strip() for a in authors or []),
+                tuple(sorted(identifiers.items())))
+
+    def get_recent_cover_url(self, title, authors, identifiers):
+        '''
+        Cover url download_cover() would pick from an identical identify()
+        call made in the last RECENT_IDENTIFY_TTL seconds
+        '''
+        with self._last_identify_lock:
+            last_identify = self._last_identify
+        if last_identify is None:
+            return None
+        timestamp, key, cover_urls = last_identify
+        if time.time() - timestamp >= self.RECENT_IDENTIFY_TTL or \
+                key != self._identify_key(title, authors, identifiers):
+            return None
+        # Already in identify_results_keygen order
+        return cover_urls[0] if cover_urls else None
+
     # To Do
     def download_cover(self, log, result_queue, abort,
             title=None, authors=None, identifiers={}, timeout=30):
         cached_url = self.get_cached_cover_url(identifiers)
+        if cached_url is None:
+            cached_url = self.get_recent_cover_url(title, authors, identifiers)
         if cached_url is None:
             log.info('No cached cover found, running identify')
             rq = Queue()
-            self.identify(log, rq, abort, title=title, authors=authors, hiddenauthors=authors,
+            self.identify(log, rq, abort, title=title, authors=authors,
                     identifiers=identifiers)
             if abort.is_set():
                 return
@@ -237,6 +286,17 @@ if __name__ == '__main__':  # tests
           ]
         ),
 
+        (  # No identifier, goes through the Audible catalog search
+          {
+             'title':'1984',
+             'authors':['George Orwell']
+          },
+          [
+             title_test('1984'),
+             authors_test(['George Orwell']),
+          ]
+        ),
+
     ]
 
     def do_test(atests, start=0, stop=None):
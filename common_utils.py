@@ -1,7 +1,5 @@
 #!/usr/bin/env python
 # vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
-from __future__ import (unicode_literals, division, absolute_import,
-                        print_function)
 
 __license__   = 'GPL v3'
 __copyright__ = '2011, Grant Drake <grant.drake@gmail.com>, 2012-2021 updates by David Forrester <davidfor@internode.on.net>'
@@ -9,10 +7,6 @@ __docformat__ = 'restructuredtext en'
 
 import os, time, re, sys
 
-# calibre Python 3 compatibility.
-import six
-from six import text_type as unicode
-
 try:
     from PyQt5.Qt import (Qt, QIcon, QPixmap, QLabel, QDialog, QHBoxLayout, QProgressBar,
                           QTableWidgetItem, QFont, QLineEdit, QComboBox, QListWidget,
@@ -46,7 +40,7 @@ else:
     def convert_qvariant(x):
         vt = x.type()
         if vt == x.String:
-            return unicode(x.toString())
+            return str(x.toString())
         if vt == x.List:
             return [convert_qvariant(i) for i in x.toList()]
         return x.toPyObject()
@@ -437,7 +431,7 @@ class KeyValueComboBox(QComboBox):
 
     def selected_key(self):
         for key, value in list(self.values.items()):
-            if value == unicode(self.currentText()).strip():
+            if value == str(self.currentText()).strip():
                 return key
 
 
@@ -483,7 +477,7 @@ class KeyComboBox(QComboBox):
 
     def selected_key(self):
         for key, value in list(self.values.items()):
-            if key == unicode(self.currentText()).strip():
+            if key == str(self.currentText()).strip():
                 return key
 
 
@@ -506,7 +500,7 @@ class SimpleComboBox(QComboBox):
 
     def selected_key(self):
         for value in list(self.values):
-            if value == unicode(self.currentText()).strip():
+            if value == str(self.currentText()).strip():
                 return value
 
 
@@ -755,7 +749,7 @@ class PrefsViewerDialog(SizePersistedDialog):
         if new_row < 0:
             self.value_text.clear()
             return
-        key = unicode(self.keys_list.currentItem().text())
+        key = str(self.keys_list.currentItem().text())
         val = self.db.prefs.get_namespaced(self.namespace, key, '')
         self.value_text.setPlainText(self.db.prefs.to_raw(val))
 
@@ -771,8 +765,8 @@ class PrefsViewerDialog(SizePersistedDialog):
         if not confirm(message, self.namespace+'_clear_settings', self):
             return
 
-        val = self.db.prefs.raw_to_object(unicode(self.value_text.toPlainText()))
-        key = unicode(self.keys_list.currentItem().text())
+        val = self.db.prefs.raw_to_object(str(self.value_text.toPlainText()))
+        key = str(self.keys_list.currentItem().text())
         self.db.prefs.set_namespaced(self.namespace, key, val)
 
         restart = prompt_for_restart(self, 'Settings changed',
@@ -1,8 +1,6 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 # vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
-from __future__ import (unicode_literals, division, absolute_import,
-                        print_function)
 
 __license__   = 'GPL v3'
 __copyright__ = '2014, Roman Cupisz <roman.cupisz+calibre@gmail.com>, 2015-2021 improvements by Becky <becky@fr.pl>'
@@ -11,8 +9,6 @@ __docformat__ = 'restructuredtext en'
 import copy
 from functools import partial
 
-from six import text_type as unicode
-
 try:
     from PyQt5.Qt import (QTableWidgetItem, QVBoxLayout, Qt, QGroupBox, QTableWidget,
                           QCheckBox, QAbstractItemView, QHBoxLayout, QIcon,
@@ -41,6 +37,8 @@ from calibre_plugins.audible.common_utils import ReadOnlyTableWidgetItem
 
 STORE_NAME = 'Options'
 KEY_GENRE_MAPPINGS = 'genreMappings'
+KEY_MAX_WORKERS = 'maxWorkers'
+KEY_MAX_CANDIDATES = 'maxCandidates'
 
 DEFAULT_GENRE_MAPPINGS = {
                 'Anthologies': ['Anthologies'],
@@ -103,7 +101,9 @@ DEFAULT_GENRE_MAPPINGS = {
                 }
 
 DEFAULT_STORE_VALUES = {
-    KEY_GENRE_MAPPINGS: copy.deepcopy(DEFAULT_GENRE_MAPPINGS)
+    KEY_GENRE_MAPPINGS: copy.deepcopy(DEFAULT_GENRE_MAPPINGS),
+    KEY_MAX_WORKERS: 8,
+    KEY_MAX_CANDIDATES: 5
 }
 
 # This is where all preferences for this plugin will be stored
@@ -185,8 +185,8 @@ class GenreTagMappingsTableWidget(QTableWidget):
     def get_data(self):
         tag_mappings = {}
         for row in range(self.rowCount()):
-            genre = unicode(self.item(row, 0).text()).strip()
-            tags_text = unicode(self.cellWidget(row, 1).text()).strip()
+            genre = str(self.item(row, 0).text()).strip()
+            tags_text = str(self.cellWidget(row, 1).text()).strip()
             tag_values = tags_text.split(',')
             tags_list = []
             for tag in tag_values:
@@ -197,13 +197,13 @@ class GenreTagMappingsTableWidget(QTableWidget):
 
     def select_genre(self, genre_name):
         for row in range(self.rowCount()):
-            if unicode(self.item(row, 0).text()) == genre_name:
+            if str(self.item(row, 0).text()) == genre_name:
                 self.setCurrentCell(row, 1)
                 return
 
     def get_selected_genre(self):
         if self.currentRow() >= 0:
-            return unicode(self.item(self.currentRow(), 0).text())
+            return str(self.item(self.currentRow(), 0).text())
 
 
 class ConfigWidget(DefaultConfigWidget):
@@ -264,7 +264,7 @@ class ConfigWidget(DefaultConfigWidget):
 
     def commit(self):
         DefaultConfigWidget.commit(self)
-        new_prefs = {}
+        new_prefs = dict(plugin_prefs[STORE_NAME])
         new_prefs[KEY_GENRE_MAPPINGS] = self.edit_table.get_data()
         plugin_prefs[STORE_NAME] = new_prefs
 
@@ -274,7 +274,7 @@ class ConfigWidget(DefaultConfigWidget):
         if not ok:
             # Operation cancelled
             return
-        new_genre_name = unicode(new_genre_name).strip()
+        new_genre_name = str(new_genre_name).strip()
         if not new_genre_name:
             return
         # Verify it does not clash with any other mappings in the list
@@ -305,7 +305,7 @@ class ConfigWidget(DefaultConfigWidget):
         if not ok:
             # Operation cancelled
             return
-        new_genre_name = unicode(new_genre_name).strip()
+        new_genre_name = str(new_genre_name).strip()
         if not new_genre_name or new_genre_name == selected_genre:
             return
         data = self.edit_table.get_data()
@@ -1,49 +1,303 @@
 #!/usr/bin/env python
 # -*- coding: UTF-8 -*-
 # vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
-from __future__ import (unicode_literals, division, absolute_import,
-                        print_function)
 
 __license__   = 'GPL v3'
 __copyright__ = '2021, Igor Kaldowski <>'
 __docformat__ = 'restructuredtext en'
 
-# import six
-from six import text_type as unicode
-from six.moves import range
-
-from lxml.html import fromstring, tostring
-
 # from itertools import compress
-import socket, re, datetime
-
-# from collections import OrderedDict
-from threading import Thread
+import socket, re, datetime, time, unicodedata
+
+from collections import OrderedDict
+from functools import wraps
+from threading import Lock, Thread, current_thread
+from queue import Queue
+from concurrent.futures import Future
+
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
+
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+except ImportError:
+    requests = None
 
 from calibre.ebooks.metadata.book.base import Metadata
 from calibre.library.comments import sanitize_comments_html
 from calibre.utils.cleantext import clean_ascii_chars
-from calibre.ebooks.metadata import check_isbn
 # from calibre.utils.icu import capitalize, lower
 
 import calibre_plugins.audible.config as cfg
 
-import json
 
-class Worker(Thread):  # Get details
+# All lookups go to the same few hosts, so share one keep-alive connection
+# pool between every worker instead of paying a new handshake per request.
+_session = None
+_session_lock = Lock()
 
+def get_session():
+    '''
+    Return the shared requests session, or None if requests is not available
     '''
-    Get book details from Audnexus in a separate thread
+    global _session
+    if requests is None:
+        return None
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32,
+                    max_retries=Retry(total=2, backoff_factor=0.3))
+            session.mount('https://', adapter)
+            session.headers.update({'Connection': 'keep-alive', 'Accept-Encoding': 'gzip'})
+            _session = session
+    return _session
+
+class WorkerPool(object):
+    '''
+    Minimal thread pool with daemon threads, so like the per-lookup threads
+    it replaced, a slow fetch never holds up calibre's exit. submit() returns
+    a concurrent.futures.Future, queued futures can be cancelled.
+    '''
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self.queue = Queue()
+        self.lock = Lock()
+        self.threads = []
+
+    def submit(self, fn):
+        future = Future()
+        self.queue.put((future, fn))
+        with self.lock:
+            if len(self.threads) < self.max_workers:
+                thread = Thread(target=self._run, name='audible-worker')
+                thread.daemon = True
+                self.threads.append(thread)
+                thread.start()
+        return future
+
+    def _run(self):
+        while True:
+            future, fn = self.queue.get()
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn())
+                except BaseException as e:
+                    future.set_exception(e)
+            with self.lock:
+                # Shrink after max_workers was lowered
+                if len(self.threads) > self.max_workers:
+                    self.threads.remove(current_thread())
+                    return
+
+# Pool threads are reused across identify() calls rather than started per call
+_executor = None
+_executor_lock = Lock()
+
+def get_executor():
+    '''
+    Return the shared pool used to run workers, sized from the current prefs
+    '''
+    global _executor
+    max_workers = cfg.get_plugin_pref(cfg.STORE_NAME, cfg.KEY_MAX_WORKERS)
+    with _executor_lock:
+        if _executor is None:
+            _executor = WorkerPool(max_workers)
+        else:
+            _executor.max_workers = max_workers
+    return _executor
+
+def open_url(url, browser, timeout):
+    '''
+    Fetch url through the shared session, falling back to the calibre browser
+    '''
+    session = get_session()
+    if session is None:
+        return browser.open_novisit(url, timeout=timeout).read()
+    response = session.get(url, timeout=timeout)
+    response.raise_for_status()
+    return response.content
+
+def _memoize_ttl(ttl):
+    '''
+    Cache results by the first argument for ttl seconds. Calls made while the
+    same key is already being fetched wait for that result instead of fetching
+    again. Failures are passed to those waiters but not cached.
+    '''
+    def decorator(func):
+        # key -> (completion time or None while in flight, Future)
+        cache = {}
+        lock = Lock()
+
+        @wraps(func)
+        def wrapper(key, *args, **kwargs):
+            now = time.time()
+            with lock:
+                for k in [k for k, entry in cache.items()
+                        if entry[0] is not None and now - entry[0] >= ttl]:
+                    del cache[k]
+                entry = cache.get(key)
+                if entry is None:
+                    future = Future()
+                    cache[key] = (None, future)
+            if entry is not None:
+                return entry[1].result()
+
+            try:
+                result = func(key, *args, **kwargs)
+            except BaseException as e:
+                with lock:
+                    del cache[key]
+                future.set_exception(e)
+                raise
+            with lock:
+                cache[key] = (time.time(), future)
+            future.set_result(result)
+            return result
+        return wrapper
+    return decorator
+
+# Bulk metadata downloads run identify() for many books in parallel, so
+# identical searches are shared for a short while.
+@_memoize_ttl(30)
+def audible_search(query_url, browser, timeout):
+    '''
+    Run an Audible catalog search and return the parsed json
+    '''
+    return _json.loads(open_url(query_url, browser, timeout))
+
+def get_error_code(e):
+    '''
+    HTTP status code of a failed open_url() call, if there is one
+    '''
+    if callable(getattr(e, 'getcode', None)):
+        return e.getcode()
+    response = getattr(e, 'response', None)
+    return getattr(response, 'status_code', None)
+
+# Audnexus book json by ASIN, so repeated identify() calls (e.g. the one
+# download_cover() makes) do not hit the API again. Entries are kept in
+# insertion order, so the oldest (and first to expire) are at the front.
+ASIN_CACHE_TTL = 3600
+ASIN_CACHE_SIZE = 500
+_asin_cache = OrderedDict()
+_asin_cache_lock = Lock()
+
+def get_cached_book(asin):
+    with _asin_cache_lock:
+        entry = _asin_cache.get(asin)
+        if entry is None:
+            return None
+        if time.time() - entry[0] >= ASIN_CACHE_TTL:
+            del _asin_cache[asin]
+            return None
+        return entry[1]
+
+def cache_book(asin, root):
+    now = time.time()
+    with _asin_cache_lock:
+        _asin_cache.pop(asin, None)
+        _asin_cache[asin] = (now, root)
+        while _asin_cache:
+            oldest_asin, (timestamp, _root) = next(iter(_asin_cache.items()))
+            if now - timestamp < ASIN_CACHE_TTL and len(_asin_cache) <= ASIN_CACHE_SIZE:
+                break
+            del _asin_cache[oldest_asin]
+
+def normalize_genre(genre):
+    '''
+    Fold case, accents, whitespace and unicode dashes (e.g. non-breaking hyphens)
+    '''
+    genre = unicodedata.normalize('NFKD', genre)
+    genre = ''.join('-' if unicodedata.category(c) == 'Pd' else c
+            for c in genre if not unicodedata.combining(c))
+    return ' '.join(genre.lower().split())
+
+# Normalized genre mappings, rebuilt whenever the stored mappings change
+_calibre_tag_map = {}
+_calibre_tag_lookup = None
+_calibre_tag_lock = Lock()
+
+def get_calibre_tag_map():
+    global _calibre_tag_map, _calibre_tag_lookup
+    calibre_tag_lookup = cfg.plugin_prefs[cfg.STORE_NAME][cfg.KEY_GENRE_MAPPINGS]
+    with _calibre_tag_lock:
+        # Saving the config replaces the stored dict, so identity is enough
+        if calibre_tag_lookup is not _calibre_tag_lookup:
+            _calibre_tag_map = dict((normalize_genre(k),v) for (k,v) in calibre_tag_lookup.items())
+            _calibre_tag_lookup = calibre_tag_lookup
+        return _calibre_tag_map
+
+# Fields parse_details() cannot do without, see product_to_book()
+BOOK_REQUIRED_FIELDS = ('asin', 'title', 'authors', 'image')
+
+def product_to_book(product):
+    '''
+    Convert a product from the Audible catalog search into the Audnexus book
+    layout parse_details() expects. Returns None if required fields are missing.
+    '''
+    book = {
+        'asin': product.get('asin'),
+        'title': product.get('title'),
+        'authors': product.get('authors') or [],
+        'narrators': product.get('narrators') or [],
+        'publisherName': product.get('publisher_name'),
+        'summary': product.get('publisher_summary') or product.get('merchandising_summary'),
+        'language': product.get('language'),
+    }
+
+    # Use the largest cover Audible returned, not all sizes exist for every book
+    images = product.get('product_images') or {}
+    sizes = [size for size in images if size.isdigit() and images[size]]
+    book['image'] = images[max(sizes, key=int)] if sizes else None
+
+    if product.get('release_date'):
+        book['releaseDate'] = product['release_date'] + 'T00:00:00.000Z'
+
+    rating = (product.get('rating') or {}).get('overall_distribution') or {}
+    if rating.get('display_average_rating'):
+        book['rating'] = rating['display_average_rating']
+
+    series = product.get('series') or []
+    book['seriesPrimary'] = None
+    if series and series[0].get('sequence'):
+        book['seriesPrimary'] = {'name': series[0]['title'],
+                                 'position': 'Book ' + series[0]['sequence']}
+
+    genres = []
+    for ladder in product.get('category_ladders') or []:
+        for category in ladder.get('ladder') or []:
+            if category.get('name') and {'name': category['name']} not in genres:
+                genres.append({'name': category['name']})
+    book['genres'] = genres
+
+    for field in BOOK_REQUIRED_FIELDS:
+        if not book[field]:
+            return None
+    return book
+
+class Worker(object):  # Get details
+
+    '''
+    Get book details from Audnexus, run() is submitted to a thread pool
     '''
 
     def __init__(self, url, result_queue, browser, log, relevance, plugin, timeout=20):
-        Thread.__init__(self)
-        self.daemon = True
         self.url, self.result_queue = url, result_queue
         self.log, self.timeout = log, timeout
         self.relevance, self.plugin = relevance, plugin
-        self.browser = browser.clone_browser()
-        self.cover_url = self.audible_id = self.isbn = None
+        self.session = get_session()
+        # mechanize browsers are not thread safe, only clone one if we need it.
+        # browser is None for workers that only parse an existing response.
+        self.browser = None
+        if self.session is None and browser is not None:
+            self.browser = browser.clone_browser()
+        self.cover_url = self.audible_id = self.isbn = self.mi = None
 
     def run(self):
         try:
@@ -52,18 +306,25 @@ class Worker(Thread):  # Get details
             self.log.exception('get_details failed for url: %r'%self.url)
 
     def get_details(self):
+        asin = self.url.rstrip('/').rpartition('/')[2]
+        root = get_cached_book(asin)
+        if root is not None:
+            self.log.info('Audnexus.us cached: %r'%asin)
+            self.parse_details(root)
+            return
+
         try:
             self.log.info('Audnexus.us   url: %r'%self.url)
-            raw = self.browser.open_novisit(self.url, timeout=self.timeout).read()
+            raw = open_url(self.url, self.browser, self.timeout)
 
         except Exception as e:
-            if callable(getattr(e, 'getcode', None)) and \
-                    e.getcode() == 404:
+            if get_error_code(e) == 404:
                 self.log.error('URL malformed: %r'%self.url)
                 return
             attr = getattr(e, 'args', [None])
             attr = attr if attr else [None]
-            if isinstance(attr[0], socket.timeout):
+            if isinstance(attr[0], socket.timeout) or \
+                    (requests is not None and isinstance(e, requests.Timeout)):
                 msg = 'Audnexus.us timed out. Try again later.'
                 self.log.error(msg)
             else:
@@ -71,31 +332,18 @@ class Worker(Thread):  # Get details
                 self.log.exception(msg)
             return
 
-        root = json.loads(raw)
+        root = _json.loads(raw)
         if not root:
             self.log.error('Failed to get json result for query')
             return
 
+        cache_book(asin, root)
         self.parse_details(root)
 
     def parse_details(self, root):
-        try:
-            audible_id = root["asin"]
-        except:
-            self.log.exception('Error parsing audible id for url: %r'%self.url)
-            audible_id = None
-
-        try:
-            title = root["title"]
-        except:
-            self.log.exception('Error parsing title for url: %r'%self.url)
-            title = None
-
-        try:
-            authors = self.parse_authors(root)
-        except:
-            self.log.exception('Error parsing authors for url: %r'%self.url)
-            authors = []
+        audible_id = root.get("asin")
+        title = root.get("title")
+        authors = self.parse_authors(root)
 
         if not title or not authors or not audible_id:
             self.log.error('Could not find title/authors/audible id for %r'%self.url)
@@ -108,11 +356,8 @@ class Worker(Thread):  # Get details
         mi.set_identifier('audible', audible_id)
         self.audible_id = audible_id
 
-        try:
-            narrators = self.parse_narrators(root)
-        except:
-            self.log.exception('Error parsing authors for url: %r'%self.url)
-            authors = []
+        missing = []
+        narrators = self.parse_narrators(root)
 
         try:
             (series, series_index) = self.parse_series(root)
@@ -124,44 +369,46 @@ class Worker(Thread):  # Get details
 
         try:
             mi.rating = float(root["rating"])
-        except:
-            self.log.exception('Error parsing ratings for url: %r'%self.url)
+        except (KeyError, TypeError, ValueError):
+            missing.append('rating')
 
-        try:
-            summary = root["summary"]
-        except:
-            self.log.exception('Error parsing comments for url: %r'%self.url)
+        summary = root.get("summary")
+        if summary is None:
+            missing.append('summary')
 
-        try:
-            self.cover_url = root["image"]
-        except:
-            self.log.exception('Error parsing cover for url: %r'%self.url)
+        self.cover_url = root.get("image")
+        if not self.cover_url:
+            missing.append('image')
         mi.has_cover = bool(self.cover_url)
 
-        try:
-            tags = self.parse_tags(root)
-            if tags is not None:
-                mi.tags = tags
-        except:
-            self.log.exception('Error parsing tags for url: %r'%self.url)
+        tags = self.parse_tags(root)
+        if tags is not None:
+            mi.tags = tags
 
-        try:
-            mi.publisher = root["publisherName"]
-        except:
-            self.log.exception('Error parsing publisher for url: %r'%self.url)
+        mi.publisher = root.get("publisherName")
+        if mi.publisher is None:
+            missing.append('publisherName')
 
-        try:
-            mi.pubdate = self._convert_date_text(root["releaseDate"])
-        except:
-            self.log.exception('Error parsing date for url: %r'%self.url)
+        release_date = root.get("releaseDate")
+        if release_date:
+            try:
+                mi.pubdate = self._convert_date_text(release_date)
+            except:
+                self.log.exception('Error parsing date for url: %r'%self.url)
+        else:
+            missing.append('releaseDate')
 
-        try:
-            mi.language = root["language"].capitalize()
-        except:
-            self.log.exception('Error parsing language for url: %r'%self.url)
+        language = root.get("language")
+        if language:
+            mi.language = language.capitalize()
+        else:
+            missing.append('language')
+
+        if missing:
+            self.log.warn('Missing %s for url: %r'%(', '.join(missing), self.url))
 
         commets = ""
-        if narrators is not None:
+        if narrators:
             commets = '<p id="narrators">Narrators: ' +  ', '.join(narrators)  + '</p>' + commets 
         if summary is not None:
             commets = commets + summary
@@ -177,28 +424,21 @@ class Worker(Thread):  # Get details
                 self.plugin.cache_identifier_to_cover_url(self.audible_id, self.cover_url)
 
         self.plugin.clean_downloaded_metadata(mi)
+        self.mi = mi
         self.result_queue.put(mi)
 
     def _convert_date_text(self, date_text):
-        year = int(datetime.datetime.strptime(date_text, '%Y-%m-%dT%H:%M:%S.%fZ').strftime('%Y'))
-        month = int(datetime.datetime.strptime(date_text, '%Y-%m-%dT%H:%M:%S.%fZ').strftime('%m'))
-        day = int(datetime.datetime.strptime(date_text, '%Y-%m-%dT%H:%M:%S.%fZ').strftime('%d'))
-        return datetime.datetime(year, month, day, 0, 0, 0)
+        # Fixed width ISO 8601 (YYYY-MM-DDTHH:MM:SS.fffZ), only the date is used
+        return datetime.datetime(int(date_text[0:4]), int(date_text[5:7]), int(date_text[8:10]), 0, 0, 0)
 
     def parse_authors(self, root):
-        authors = []
-        for author in root["authors"]:
-            authors.append(author["name"])
-        return authors
+        return [author["name"] for author in root.get("authors") or [] if author.get("name")]
 
     def parse_narrators(self, root):
-        narrators = []
-        for narrator in root["narrators"]:
-            narrators.append(narrator["name"])
-        return narrators
+        return [narrator["name"] for narrator in root.get("narrators") or [] if narrator.get("name")]
         
     def parse_series(self, root):
-        series_node = root["seriesPrimary"]
+        series_node = root.get("seriesPrimary")
         if not series_node:
             return (None, None)
             
@@ -210,23 +450,19 @@ class Worker(Thread):  # Get details
         return (series, series_index)
 
     def parse_tags(self, root):
-        genres_node = root["genres"]
-        if genres_node:
-            genre_tags = list()
-            for genre_node in genres_node:
-                genre_tags.append(genre_node["name"])
-            calibre_tags = self._convert_genres_to_calibre_tags(genre_tags)
-            if len(calibre_tags) > 0:
-                return calibre_tags
+        genre_tags = [genre_node["name"] for genre_node in root.get("genres") or []
+                if genre_node.get("name")]
+        return self._convert_genres_to_calibre_tags(genre_tags) or None
 
     def _convert_genres_to_calibre_tags(self, genre_tags):
-        calibre_tag_lookup = cfg.plugin_prefs[cfg.STORE_NAME][cfg.KEY_GENRE_MAPPINGS]
-        calibre_tag_map = dict((k.lower(),v) for (k,v) in calibre_tag_lookup.items())
+        calibre_tag_map = get_calibre_tag_map()
         tags_to_add = list()
+        seen = set()
         for genre_tag in genre_tags:
-            tags = calibre_tag_map.get(genre_tag.lower(), None)
+            tags = calibre_tag_map.get(normalize_genre(genre_tag), None)
             if tags:
                 for tag in tags:
-                    if tag not in tags_to_add:
+                    if tag not in seen:
+                        seen.add(tag)
                         tags_to_add.append(tag)
-        return list(tags_to_add)
\ No newline at end of file
+        return tags_to_add